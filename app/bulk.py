@@ -0,0 +1,297 @@
+"""Bulk import and export of users, chats, memberships and messages.
+
+Records are streamed from and to NDJSON or CSV files, one entity kind per
+file. Imports are written in batches with ``COPY ... FROM STDIN`` on
+PostgreSQL and ``executemany`` inserts elsewhere, so memory only depends on
+the batch size. Passwords have to be hashes already, no bcrypt work is done.
+
+    python -m app.bulk import users users.ndjson --checkpoint users.checkpoint
+    python -m app.bulk export messages messages.csv
+"""
+import argparse
+import csv
+import io
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Iterator, TextIO
+
+import orjson
+from sqlalchemy import Table, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.auth import AuthHandler
+from app.compression import compress_value, decompress_value
+from app.db import engine
+from app.dtos import USERNAME_REGEX
+from app.models import User, Chat, UserChat, Message, Role, MessageType, uuid7
+
+BATCH_SIZE = 5000
+FORMATS = ("ndjson", "csv")
+
+auth_handler = AuthHandler()
+
+
+class BulkImportError(ValueError):
+    def __init__(self, message: str, records: int):
+        super().__init__(message)
+        self.records = records
+
+
+def to_uuid(value: Any) -> uuid.UUID:
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+def to_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "t", "yes")
+
+
+def to_datetime(value: Any) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+
+def to_username(value: Any) -> str:
+    if re.fullmatch(USERNAME_REGEX, str(value)) is None:
+        raise ValueError("username may only contain latin letters, digits and underscores")
+    return str(value)
+
+
+def to_chat_name(value: Any) -> str:
+    if not str(value):
+        raise ValueError("chat name can not be empty")
+    return str(value)
+
+
+def to_password_hash(value: Any) -> str:
+    if auth_handler.pwd_context.identify(str(value)) is None:
+        raise ValueError("password has to be a hash")
+    return str(value)
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# column name -> (converter, default factory or None when the column is required)
+KINDS: dict[str, tuple[Table, dict[str, tuple[Callable[[Any], Any], Callable[[], Any] | None]]]] = {
+    "users": (User.__table__, {
+        "id": (to_uuid, uuid.uuid4),
+        "username": (to_username, None),
+        "password": (to_password_hash, None),
+        "role": (lambda value: Role(value).value, lambda: Role.USER.value),
+        "blocked": (to_bool, lambda: False),
+        "version": (int, lambda: 1),
+    }),
+    "chats": (Chat.__table__, {
+        "id": (to_uuid, uuid.uuid4),
+        "chat_name": (to_chat_name, None),
+        "version": (int, lambda: 1),
+        "deleted_at": (to_datetime, lambda: None),
+    }),
+    "memberships": (UserChat.__table__, {
+        "chat_id": (to_uuid, None),
+        "user_id": (to_uuid, None),
+    }),
+    "messages": (Message.__table__, {
+        "id": (to_uuid, uuid7),
+        "chat_id": (to_uuid, None),
+        "user_id": (to_uuid, lambda: None),
+        "value": (lambda value: compress_value(str(value)), lambda: ""),
+        "message_type": (lambda value: MessageType(value).value, lambda: MessageType.TEXT.value),
+        "datetime": (to_datetime, now),
+        "read": (to_bool, lambda: False),
+        "version": (int, lambda: 1),
+    }),
+}
+
+
+def read_records(file: TextIO, file_format: str) -> Iterator[dict]:
+    if file_format == "ndjson":
+        for line in file:
+            if line.strip():
+                yield orjson.loads(line)
+    elif file_format == "csv":
+        for row in csv.DictReader(file):
+            yield {key: value for key, value in row.items() if value != ""}
+    else:
+        raise ValueError(f"Unknown format {file_format}")
+
+
+def convert_record(kind: str, record: dict, index: int) -> dict:
+    _, columns = KINDS[kind]
+    if not isinstance(record, dict):
+        raise ValueError(f"Record {index}: has to be an object")
+    result = {}
+    for name, (converter, default) in columns.items():
+        value = record.get(name)
+        if value is None:
+            if default is None:
+                raise ValueError(f"Record {index}: {name} is required")
+            result[name] = default()
+            continue
+        try:
+            result[name] = converter(value)
+        except (ValueError, TypeError) as error:
+            raise ValueError(f"Record {index}: invalid {name}: {error}")
+    return result
+
+
+def copy_field(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def write_batch(engine: Engine, kind: str, batch: list[dict]):
+    table, columns = KINDS[kind]
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write(",".join(copy_field(row[name]) for name in columns))
+                buffer.write("\n")
+            buffer.seek(0)
+            cursor = connection.connection.cursor()
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        else:
+            connection.execute(table.insert(), batch)
+        if kind == "messages":
+            # Invalidates the ETags of the chats that got new messages
+            connection.execute(update(Chat)
+                               .where(Chat.id.in_(list({row["chat_id"] for row in batch})))
+                               .values(version=Chat.version + 1))
+
+
+def import_records(engine: Engine, kind: str, records: Iterable[dict], batch_size: int = BATCH_SIZE,
+                   offset: int = 0, checkpoint: Callable[[int], None] | None = None) -> int:
+    """Inserts ``records`` in committed batches and returns the number of records done.
+
+    The first ``offset`` records are skipped, ``checkpoint`` is called with the
+    new count after every commit so an interrupted import can be resumed.
+    Any failure is raised as ``BulkImportError`` carrying the number of
+    records committed so far, which is the offset to resume from.
+    """
+    if kind not in KINDS:
+        raise BulkImportError(f"Unknown kind {kind}", offset)
+    done = offset
+    batch: list[dict] = []
+    records = iter(records)
+    index = 0
+    while True:
+        try:
+            record = next(records)
+        except StopIteration:
+            break
+        except (ValueError, csv.Error) as error:
+            raise BulkImportError(f"Record {index}: unreadable: {error}", done)
+        if index >= offset:
+            try:
+                batch.append(convert_record(kind, record, index))
+            except ValueError as error:
+                raise BulkImportError(str(error), done)
+        index += 1
+        if len(batch) >= batch_size:
+            done = commit_batch(engine, kind, batch, done, checkpoint)
+            batch = []
+    if batch:
+        done = commit_batch(engine, kind, batch, done, checkpoint)
+    return done
+
+
+def commit_batch(engine: Engine, kind: str, batch: list[dict], done: int,
+                 checkpoint: Callable[[int], None] | None) -> int:
+    try:
+        write_batch(engine, kind, batch)
+    except SQLAlchemyError as error:
+        raise BulkImportError(f"Batch starting at record {done} failed: {getattr(error, 'orig', None) or error}",
+                              done)
+    done += len(batch)
+    if checkpoint is not None:
+        checkpoint(done)
+    return done
+
+
+def export_field(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def export_records(engine: Engine, kind: str, file_format: str, batch_size: int = BATCH_SIZE) -> Iterator[str]:
+    table, columns = KINDS[kind]
+    with engine.connect() as connection:
+        result = (connection
+                  .execution_options(stream_results=True, yield_per=batch_size)
+                  .execute(select(*[table.c[name] for name in columns])))
+        if kind == "messages":
+            rows = (dict(row._mapping, value=decompress_value(row.value)) for row in result)
+        else:
+            rows = (dict(row._mapping) for row in result)
+        if file_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([export_field(row[name]) for name in columns])
+                if buffer.tell() >= 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            for row in rows:
+                yield orjson.dumps(row).decode() + "\n"
+
+
+def read_checkpoint(path: str | None) -> int:
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as file:
+        return orjson.loads(file.read())["records"]
+
+
+def write_checkpoint(path: str, records: int):
+    with open(f"{path}.tmp", "w") as file:
+        file.write(orjson.dumps({"records": records}).decode())
+    os.replace(f"{path}.tmp", path)
+
+
+def guess_format(path: str) -> str:
+    return "csv" if path.endswith(".csv") else "ndjson"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import and export of messenger data")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("kind", choices=tuple(KINDS))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--checkpoint", help="file with the number of imported records, used to resume")
+    args = parser.parse_args()
+    file_format = args.format or guess_format(args.path)
+
+    if args.action == "export":
+        with open(args.path, "w", newline="") as file:
+            for chunk in export_records(engine, args.kind, file_format, args.batch_size):
+                file.write(chunk)
+        return
+    offset = read_checkpoint(args.checkpoint)
+    with open(args.path, newline="") as file:
+        done = import_records(engine, args.kind, read_records(file, file_format), args.batch_size, offset,
+                              (lambda records: write_checkpoint(args.checkpoint, records)) if args.checkpoint else None)
+    print(f"Imported {done - offset} {args.kind}, {done} records done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compression of large message bodies stored in a text column.
+
+Compressed values are stored as ``MARKER + tag + dictionary id + ":" + base64``.
+Values without the marker are plain text, so rows written before compression
+was enabled stay readable. Plain values that happen to start with the marker
+are escaped with the ``p`` tag.
+"""
+import base64
+import hashlib
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MARKER = "\x01"
+PLAIN_TAG = "p"
+ZLIB_TAG = "z"
+ZSTD_TAG = "s"
+
+COMPRESSION_THRESHOLD = int(os.getenv("MESSAGE_COMPRESSION_THRESHOLD", "1024"))
+DICTIONARY_COMPRESSION_THRESHOLD = int(os.getenv("MESSAGE_COMPRESSION_DICTIONARY_THRESHOLD", "128"))
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def load_dictionary(path: str | None) -> bytes | None:
+    if not path:
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+DICTIONARY = load_dictionary(os.getenv("MESSAGE_COMPRESSION_DICTIONARY"))
+DICTIONARY_ID = hashlib.blake2b(DICTIONARY, digest_size=4).hexdigest() if DICTIONARY else ""
+# A dictionary pays off on short messages too, so it gets its own threshold
+THRESHOLD = DICTIONARY_COMPRESSION_THRESHOLD if DICTIONARY else COMPRESSION_THRESHOLD
+
+if zstandard is not None:
+    _zstd_dictionary = zstandard.ZstdCompressionDict(DICTIONARY) if DICTIONARY else None
+    _zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_zstd_dictionary)
+    _zstd_decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dictionary)
+
+
+def _zlib_compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(ZLIB_LEVEL, zdict=DICTIONARY) if DICTIONARY else zlib.compressobj(ZLIB_LEVEL)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(zdict=DICTIONARY) if DICTIONARY else zlib.decompressobj()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def compress_value(value: str | None, threshold: int = THRESHOLD) -> str | None:
+    if value is None:
+        return None
+    if len(value) >= threshold:
+        data = value.encode()
+        if zstandard is not None:
+            tag, compressed = ZSTD_TAG, _zstd_compressor.compress(data)
+        else:
+            tag, compressed = ZLIB_TAG, _zlib_compress(data)
+        stored = f"{MARKER}{tag}{DICTIONARY_ID}:{base64.b64encode(compressed).decode()}"
+        if len(stored) < len(value):
+            return stored
+    if value.startswith(MARKER):
+        return f"{MARKER}{PLAIN_TAG}:{value}"
+    return value
+
+
+def decompress_value(stored: str | None) -> str | None:
+    if stored is None or not stored.startswith(MARKER):
+        return stored
+    header, _, payload = stored.partition(":")
+    tag, dictionary_id = header[1:2], header[2:]
+    if tag == PLAIN_TAG:
+        return payload
+    if dictionary_id != DICTIONARY_ID:
+        raise ValueError(f"Message was compressed with dictionary {dictionary_id or 'none'}, "
+                         f"configured dictionary is {DICTIONARY_ID or 'none'}")
+    data = base64.b64decode(payload)
+    if tag == ZSTD_TAG:
+        if zstandard is None:
+            raise ValueError("Message was compressed with zstd, install zstandard to read it")
+        return _zstd_decompressor.decompress(data).decode()
+    if tag == ZLIB_TAG:
+        return _zlib_decompress(data).decode()
+    raise ValueError(f"Unknown message compression {tag}")
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+DEDUPE_CACHE_MAX_ENTRIES = int(os.getenv("DEDUPE_CACHE_MAX_ENTRIES", "10000"))
+DEDUPE_CACHE_MAX_BYTES = int(os.getenv("DEDUPE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+DEDUPE_CACHE_TTL_SECONDS = float(os.getenv("DEDUPE_CACHE_TTL_SECONDS", "600"))
+
+
+class DedupeCache:
+    """LRU cache with TTL, bounded by number of entries and by approximate size in bytes.
+
+    The caller passes the size of every value, the cache keeps the running
+    total and hit/miss/eviction counters for ``stats``.
+    """
+
+    def __init__(self,
+                 max_entries: int = DEDUPE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = DEDUPE_CACHE_MAX_BYTES,
+                 ttl: float = DEDUPE_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any, size: int):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (self.clock() + self.ttl, size, value)
+            self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "max_entries": self.max_entries,
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "ttl_seconds": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
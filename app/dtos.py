@@ -1,7 +1,9 @@
 import datetime
+from typing import Annotated, Literal
+from uuid import UUID
 
-from pydantic import BaseModel, ConfigDict
-from pydantic import constr, UUID4
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from pydantic import constr
 
 from app.models import Role, MessageType
 
@@ -10,7 +12,7 @@ PASSWORD_REGEX = r"^[A-Za-z0-9!@#$%^&*()_+=\-`~{}|:;<>,.?/]{12,}$"
 
 
 class UserDto(BaseModel):
-    id: UUID4
+    id: UUID
     username: constr(pattern=USERNAME_REGEX)
     role: Role
     blocked: bool
@@ -39,19 +41,19 @@ class AuthenticateUserDto(BaseModel):
 
 
 class EditUserRole(BaseModel):
-    id: UUID4
+    id: UUID
     role: Role
 
 
 class CreateChatDto(BaseModel):
     chat_name: constr(min_length=1)
-    users: list[UUID4]
+    users: list[UUID]
 
 
 class MessageDto(BaseModel):
-    id: UUID4
-    chat_id: UUID4
-    user_id: UUID4 | None
+    id: UUID
+    chat_id: UUID
+    user_id: UUID | None
     value: str
     message_type: MessageType
     datetime: datetime.datetime
@@ -61,7 +63,7 @@ class MessageDto(BaseModel):
 
 
 class ChatDto(BaseModel):
-    id: UUID4
+    id: UUID
     chat_name: constr(min_length=1)
     users: list[UserDto]
     last_message: MessageDto
@@ -82,13 +84,40 @@ class ChatDto(BaseModel):
 
 
 class SendMessageDto(BaseModel):
-    chat_id: UUID4
-    user_id: UUID4 | None
+    chat_id: UUID
+    user_id: UUID | None
     message_type: MessageType
     value: str
+    idempotency_key: constr(min_length=1, max_length=128) | None = None
 
 
 class EditMessageDto(BaseModel):
-    id: UUID4
+    id: UUID
     message_type: MessageType
     value: str
+
+
+class SendMessageFrame(BaseModel):
+    type: Literal["send"]
+    request_id: str | None = None
+    message_type: MessageType
+    value: str
+    idempotency_key: constr(min_length=1, max_length=128) | None = None
+
+
+class EditMessageFrame(BaseModel):
+    type: Literal["edit"]
+    request_id: str | None = None
+    id: UUID
+    message_type: MessageType
+    value: str
+
+
+class DeleteMessageFrame(BaseModel):
+    type: Literal["delete"]
+    request_id: str | None = None
+    id: UUID
+
+
+MessageFrame = Annotated[SendMessageFrame | EditMessageFrame | DeleteMessageFrame, Field(discriminator="type")]
+message_frame_adapter = TypeAdapter(MessageFrame)
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+from typing import Any, Callable
+
+import orjson
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def make_etag(*parts: Any) -> str:
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def choose_encoding(request: Request) -> str | None:
+    accepted: dict[str, float] = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.lower()] = quality
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [name for name in supported if accepted.get(name, accepted.get("*", 0.0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda name: accepted.get(name, accepted.get("*", 0.0)))
+
+
+def json_response(request: Request, content: Any, etag: str | None = None) -> Response:
+    body = orjson.dumps(content)
+    headers = {"Vary": "Accept-Encoding"}
+    if etag is not None:
+        headers["ETag"] = etag
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        encoding = choose_encoding(request)
+        if encoding == "br":
+            body = brotli.compress(body, quality=BROTLI_QUALITY)
+            headers["Content-Encoding"] = encoding
+        elif encoding == "gzip":
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def conditional_response(request: Request, version: Any, build: Callable[[], Any]) -> Response:
+    """Answers with 304 when the client already has ``version``, otherwise calls ``build``.
+
+    ``version`` should come from cheap row metadata, the DTOs are only built
+    when the client copy is stale.
+    """
+    if version is None:
+        return json_response(request, build())
+    etag = make_etag(request.url.path, version)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+    return json_response(request, build(), etag)
@@ -1,19 +1,33 @@
+import io
+import tempfile
+import threading
 from uuid import UUID
 
+import orjson
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Response, Cookie, Depends, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import RedirectResponse, ORJSONResponse
+from fastapi import FastAPI, Request, Response, Cookie, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
+import app.bulk as bulk
 import app.dtos as dtos
 import app.models as models
 import app.service as service
 from app.auth import AuthHandler
 from app.db import SessionLocal, engine
+from app.http_cache import conditional_response, json_response
 from app.initialize_db import initialize_db
+from app.presence import PresenceService, parse_event_type
+from app.profiling import (PROFILE_HEADER, StackSampler, current_endpoint, install_slow_query_log,
+                           should_sample)
+from app.purge import ChatPurger
 
 models.Base.metadata.create_all(bind=engine)
+install_slow_query_log(engine)
 
 load_dotenv("../.env")
 auth_handler = AuthHandler()
@@ -33,6 +47,41 @@ app = FastAPI(
 )
 
 
+def is_admin(token: str | None) -> bool:
+    username = auth_handler.decode_token(token=token) if token is not None else False
+    if not username:
+        return False
+    db = SessionLocal()
+    try:
+        db_user = service.get_user_by_username(db, username=username)
+        return db_user is not None and db_user.role == models.Role.ADMIN
+    finally:
+        db.close()
+
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """Profiles the request when an admin sends ``X-Profile: 1`` or it is picked by ``PROFILE_SAMPLE_RATE``."""
+    endpoint_token = current_endpoint.set(f"{request.method} {request.url.path}")
+    try:
+        requested_by_admin = request.headers.get(PROFILE_HEADER) == "1" and is_admin(request.cookies.get("token"))
+        if not (requested_by_admin or should_sample()):
+            return await call_next(request)
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            sampler.stop()
+        profile_path = await run_in_threadpool(sampler.dump, f"{request.method} {request.url.path}")
+        # Sampled requests come from ordinary users, server paths are only shown to admins
+        if requested_by_admin:
+            response.headers["X-Profile-Path"] = profile_path
+        return response
+    finally:
+        current_endpoint.reset(endpoint_token)
+
+
 class ConnectionManager:
     def __init__(self):
         self.chat_connections: dict[str, list[WebSocket]] = {}
@@ -44,30 +93,156 @@ class ConnectionManager:
         self.chat_connections[chat_id].append(websocket)
 
     def disconnect(self, websocket: WebSocket, chat_id: str):
-        if chat_id in self.chat_connections:
+        if chat_id in self.chat_connections and websocket in self.chat_connections[chat_id]:
             self.chat_connections[chat_id].remove(websocket)
             if not self.chat_connections[chat_id]:
                 del self.chat_connections[chat_id]
 
     async def broadcast_to_chat(self, chat_id: str, message: str):
         if chat_id in self.chat_connections:
-            for connection in self.chat_connections[chat_id]:
-                await connection.send_text(message)
+            for connection in list(self.chat_connections[chat_id]):
+                try:
+                    await connection.send_text(message)
+                except (WebSocketDisconnect, RuntimeError):
+                    # The peer is gone, its own handler cleans up, the others still get the message
+                    self.disconnect(connection, chat_id)
+
+    async def broadcast_json_to_chat(self, chat_id: str, message: dict):
+        await self.broadcast_to_chat(chat_id, orjson.dumps(message).decode())
+
+    async def close_chat(self, chat_id: str, reason: str):
+        for connection in self.chat_connections.pop(chat_id, []):
+            try:
+                await connection.close(code=1000, reason=reason)
+            except (WebSocketDisconnect, RuntimeError):
+                # The peer is already gone, the chat is deleted anyway
+                pass
 
 
 manager = ConnectionManager()
+presence = PresenceService(manager.broadcast_to_chat)
+chat_purger = ChatPurger(SessionLocal)
+
+
+@app.on_event("startup")
+async def start_chat_purger():
+    chat_purger.start()
+
+
+@app.on_event("shutdown")
+async def stop_chat_purger():
+    await chat_purger.stop()
+
+MESSAGE_FRAME_TYPES = {"send", "edit", "delete"}
+
+
+def is_websocket_chat_deleted(chat_id: str) -> bool:
+    try:
+        chat_uuid = UUID(chat_id)
+    except ValueError:
+        return True
+    with SessionLocal() as db:
+        return service.is_chat_deleted(db, chat_uuid)
+
+
+def get_websocket_user_id(username: str) -> UUID | None:
+    with SessionLocal() as db:
+        db_user = service.get_user_by_username(db, username=username)
+        if db_user is None or db_user.blocked:
+            return None
+        return db_user.id
+
+
+async def handle_message_frame(user_id: UUID, chat_id: str, data: str) -> dict:
+    try:
+        frame = dtos.message_frame_adapter.validate_json(data)
+    except ValidationError as error:
+        return {"type": "error",
+                "request_id": orjson.loads(data).get("request_id"),
+                "detail": error.errors(include_url=False, include_context=False)}
+    # A session per frame, a socket must not hold a pooled connection while it is idle
+    with SessionLocal() as db:
+        return await apply_message_frame(db, user_id, chat_id, frame)
+
+
+async def apply_message_frame(db: Session, user_id: UUID, chat_id: str, frame: dtos.MessageFrame) -> dict:
+    try:
+        if isinstance(frame, dtos.SendMessageFrame):
+            message_dto, created = await run_in_threadpool(
+                service.send_message_once, db=db,
+                dto=dtos.SendMessageDto(chat_id=chat_id,
+                                        user_id=user_id,
+                                        message_type=frame.message_type,
+                                        value=frame.value,
+                                        idempotency_key=frame.idempotency_key))
+            if message_dto is None:
+                return {"type": "error", "request_id": frame.request_id, "detail": "Chat not found"}
+            if created:
+                await manager.broadcast_json_to_chat(chat_id, message_dto.model_dump())
+            return {"type": "ack", "request_id": frame.request_id, "id": str(message_dto.id)}
+        owner = await run_in_threadpool(service.get_message_chat_and_user_ids, db=db, message_id=frame.id)
+        if owner is None or str(owner.chat_id) != chat_id or owner.user_id != user_id:
+            return {"type": "error", "request_id": frame.request_id, "detail": "Message not found"}
+        if isinstance(frame, dtos.EditMessageFrame):
+            message_dto = await run_in_threadpool(service.edit_message, db=db,
+                                                  dto=dtos.EditMessageDto(id=frame.id,
+                                                                          message_type=frame.message_type,
+                                                                          value=frame.value))
+            if message_dto is None:
+                return {"type": "error", "request_id": frame.request_id, "detail": "Message not found"}
+            await manager.broadcast_json_to_chat(chat_id, message_dto.model_dump())
+        else:
+            if await run_in_threadpool(service.delete_message, db=db, message_id=frame.id) is None:
+                return {"type": "error", "request_id": frame.request_id, "detail": "Message not found"}
+            await manager.broadcast_to_chat(chat_id, f"DELETE MESSAGE WITH ID: {frame.id}")
+    except (ValidationError, SQLAlchemyError):
+        db.rollback()
+        return {"type": "error", "request_id": frame.request_id, "detail": "Message was not saved"}
+    return {"type": "ack", "request_id": frame.request_id, "id": str(frame.id)}
 
 
 @app.websocket("/ws/chat/{chat_id}")
-async def chat_websocket(websocket: WebSocket, chat_id: str):
+async def chat_websocket(websocket: WebSocket, chat_id: str, token: str | None = Cookie(None)):
+    """Chat updates, presence events and message frames.
+
+    The token is checked once here, after that the connection can send
+    ``send``/``edit``/``delete`` frames without waiting for the previous ack.
+    Frames are handled in order and every ack carries the client ``request_id``.
+    """
+    if await run_in_threadpool(is_websocket_chat_deleted, chat_id):
+        await websocket.close(code=1008, reason="Chat not found")
+        return
+    username = auth_handler.decode_token(token=token) if token is not None else False
+    user_id = await run_in_threadpool(get_websocket_user_id, username) if username else None
+    if user_id is None:
+        username = False
     await manager.connect(websocket, chat_id)
+    if username:
+        presence.connect(chat_id, username)
     try:
         while True:
             data = await websocket.receive_text()
+            event_type = parse_event_type(data)
+            if username and presence.handle_event(chat_id, username, event_type):
+                continue
+            if event_type in MESSAGE_FRAME_TYPES:
+                if not username:
+                    await websocket.send_text(orjson.dumps({"type": "error",
+                                                            "request_id": None,
+                                                            "detail": "Not authenticated"}).decode())
+                    continue
+                ack = await handle_message_frame(user_id, chat_id, data)
+                await websocket.send_text(orjson.dumps(ack).decode())
+                continue
             await manager.broadcast_to_chat(chat_id, f"Chat {chat_id}: {data}")
     except WebSocketDisconnect:
         manager.disconnect(websocket, chat_id)
         await manager.broadcast_to_chat(chat_id, f"Client disconnected from chat {chat_id}")
+    finally:
+        # Binary frames and sockets closed by close_chat end the loop with other errors
+        manager.disconnect(websocket, chat_id)
+        if username:
+            presence.disconnect(chat_id, username)
 
 
 @app.get("/", response_class=RedirectResponse)
@@ -111,24 +286,41 @@ async def authenticate_user(user: dtos.AuthenticateUserDto,
 
 @app.get("/getChatList/{user_id}", response_class=ORJSONResponse)
 async def get_chat_list(user_id: UUID,
+                        request: Request,
                         token: str | None = Cookie(None),
                         db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    chat_list = service.get_chats_by_user_id(db=db, user_id=user_id)
-    result = list()
-    for chat in chat_list:
-        result.append(chat.model_dump())
-    return ORJSONResponse(result)
+    return conditional_response(request,
+                                service.get_chat_list_version(db=db, user_id=user_id),
+                                lambda: [chat.model_dump()
+                                         for chat in service.get_chats_by_user_id(db=db, user_id=user_id)])
+
 
+def get_chat_dto_or_404(db: Session, chat_id: UUID) -> dtos.ChatDto:
+    chat_dto = service.get_chat_by_id(db=db, chat_id=chat_id)
+    if chat_dto is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return chat_dto
 
-@app.post("/getChatById/{chat_id}", response_class=ORJSONResponse)
+
+def get_message_dto_or_404(db: Session, message_id: UUID) -> dtos.MessageDto:
+    message_dto = service.get_message_by_id(db=db, message_id=message_id)
+    if message_dto is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message_dto
+
+
+@app.api_route("/getChatById/{chat_id}", methods=["GET", "POST"], response_class=ORJSONResponse)
 async def get_chat_by_id(chat_id: UUID,
+                         request: Request,
                          token: str | None = Cookie(None),
                          db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    return ORJSONResponse(service.get_chat_by_id(db=db, chat_id=chat_id))
+    return conditional_response(request,
+                                service.get_chat_version(db=db, chat_id=chat_id),
+                                lambda: get_chat_dto_or_404(db, chat_id).model_dump())
 
 
 @app.post("/createChat", response_class=ORJSONResponse)
@@ -147,30 +339,44 @@ async def delete_chat(chat_id: UUID,
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
     service.delete_chat(db=db, chat_id=chat_id)
+    chat_purger.notify()
     await manager.broadcast_to_chat(str(chat_id), f"DELETE CHAT WITH ID: {chat_id}")
+    await manager.close_chat(str(chat_id), "Chat deleted")
     return ORJSONResponse("")
 
 
+@app.get("/deleteChatProgress/{chat_id}", response_class=ORJSONResponse)
+async def delete_chat_progress(chat_id: UUID,
+                               token: str | None = Cookie(None),
+                               db: Session = Depends(get_db)):
+    if not auth_handler.decode_token(token=token) or token is None:
+        return RedirectResponse("/authenticate/")
+    return ORJSONResponse(chat_purger.get_progress(db, chat_id))
+
+
 @app.get("/getMessageList/{chat_id}", response_class=ORJSONResponse)
 async def get_message_list(chat_id: UUID,
+                           request: Request,
                            token: str | None = Cookie(None),
                            db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    message_list = service.get_messages_by_chat_id(db=db, chat_id=chat_id)
-    result = list()
-    for message in message_list:
-        result.append(message.model_dump())
-    return ORJSONResponse(result)
+    return conditional_response(request,
+                                service.get_message_list_version(db=db, chat_id=chat_id),
+                                lambda: [message.model_dump()
+                                         for message in service.get_messages_by_chat_id(db=db, chat_id=chat_id)])
 
 
 @app.get("/getMessageById/{message_id}", response_class=ORJSONResponse)
 async def get_message_by_id(message_id: UUID,
+                            request: Request,
                             token: str | None = Cookie(None),
                             db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    return ORJSONResponse(service.get_message_by_id(db=db, message_id=message_id).model_dump())
+    return conditional_response(request,
+                                service.get_message_version(db=db, message_id=message_id),
+                                lambda: get_message_dto_or_404(db, message_id).model_dump())
 
 
 @app.post("/sendMessage", response_class=ORJSONResponse)
@@ -179,9 +385,12 @@ async def send_message(request: dtos.SendMessageDto,
                        db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    message_dto: dtos.MessageDto = service.send_message(db=db, dto=request)
-    await manager.broadcast_to_chat(str(request.chat_id), message_dto.model_dump())
-    return ORJSONResponse("")
+    message_dto, created = service.send_message_once(db=db, dto=request)
+    if message_dto is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if created:
+        await manager.broadcast_json_to_chat(str(request.chat_id), message_dto.model_dump())
+    return ORJSONResponse(message_dto.model_dump())
 
 
 @app.put("/editMessage", response_class=ORJSONResponse)
@@ -190,8 +399,10 @@ async def edit_message(request: dtos.EditMessageDto,
                        db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    message_dto: dtos.MessageDto = service.edit_message(db=db, dto=request)
-    await manager.broadcast_to_chat(str(request.chat_id), message_dto.model_dump())
+    message_dto = service.edit_message(db=db, dto=request)
+    if message_dto is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    await manager.broadcast_json_to_chat(str(message_dto.chat_id), message_dto.model_dump())
     return ORJSONResponse("")
 
 
@@ -201,8 +412,10 @@ async def read_message(message_id: UUID,
                        db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    message_dto: dtos.MessageDto = service.read_message(db=db, message_id=message_id)
-    await manager.broadcast_to_chat(str(message_dto.chat_id), message_dto.model_dump())
+    message_dto = service.read_message(db=db, message_id=message_id)
+    if message_dto is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    await manager.broadcast_json_to_chat(str(message_dto.chat_id), message_dto.model_dump())
     return ORJSONResponse("")
 
 
@@ -213,22 +426,28 @@ async def delete_message(message_id: UUID,
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
     chat_id = service.delete_message(db=db, message_id=message_id)
+    if chat_id is None:
+        raise HTTPException(status_code=404, detail="Message not found")
     await manager.broadcast_to_chat(str(chat_id), f"DELETE MESSAGE WITH ID: {message_id}")
     return ORJSONResponse("")
 
 
 @app.get("/getUserById/{user_id}", response_class=ORJSONResponse)
 async def get_user_by_id(user_id: UUID,
+                         request: Request,
                          token: str | None = Cookie(None),
                          db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
-    return ORJSONResponse(service.get_user_by_id(db=db, user_id=user_id).model_dump())
+    return conditional_response(request,
+                                service.get_user_version(db=db, user_id=user_id),
+                                lambda: service.get_user_by_id(db=db, user_id=user_id).model_dump())
 
 
 # Admin endpoints
 @app.get("/getAllChats", response_class=ORJSONResponse)
-async def get_chat_list(token: str | None = Cookie(None),
+async def get_chat_list(request: Request,
+                        token: str | None = Cookie(None),
                         db: Session = Depends(get_db)):
     if not auth_handler.decode_token(token=token) or token is None:
         return RedirectResponse("/authenticate/")
@@ -236,7 +455,14 @@ async def get_chat_list(token: str | None = Cookie(None),
     result = list()
     for chat in chat_list:
         result.append(chat.model_dump())
-    return ORJSONResponse(result)
+    return json_response(request, result)
+
+
+@app.get("/getSendCacheStats", response_class=ORJSONResponse)
+async def get_send_cache_stats(token: str | None = Cookie(None)):
+    if not auth_handler.decode_token(token=token) or token is None:
+        return RedirectResponse("/authenticate/")
+    return ORJSONResponse(service.sent_message_cache.stats())
 
 
 @app.put("/editUserRole", response_class=ORJSONResponse)
@@ -259,5 +485,45 @@ async def block_user(user_id: UUID,
     return ORJSONResponse("")
 
 
+@app.post("/importData/{kind}", response_class=ORJSONResponse)
+async def import_data(kind: str,
+                      request: Request,
+                      format: str = "ndjson",
+                      offset: int = 0,
+                      token: str | None = Cookie(None)):
+    if not auth_handler.decode_token(token=token) or token is None:
+        return RedirectResponse("/authenticate/")
+    if not is_admin(token):
+        raise HTTPException(status_code=403, detail="Only admins can import data")
+    if kind not in bulk.KINDS or format not in bulk.FORMATS:
+        raise HTTPException(status_code=400, detail="Unknown kind or format")
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        file = io.TextIOWrapper(body, encoding="utf-8", newline="")
+        try:
+            records = await run_in_threadpool(bulk.import_records, engine, kind, bulk.read_records(file, format),
+                                              offset=offset)
+        except bulk.BulkImportError as error:
+            # Parse and database errors alike, ``records`` is the offset to resume from
+            raise HTTPException(status_code=400, detail={"message": str(error), "records": error.records})
+    return ORJSONResponse({"records": records})
+
+
+@app.get("/exportData/{kind}")
+async def export_data(kind: str,
+                      format: str = "ndjson",
+                      token: str | None = Cookie(None)):
+    if not auth_handler.decode_token(token=token) or token is None:
+        return RedirectResponse("/authenticate/")
+    if not is_admin(token):
+        raise HTTPException(status_code=403, detail="Only admins can export data")
+    if kind not in bulk.KINDS or format not in bulk.FORMATS:
+        raise HTTPException(status_code=400, detail="Unknown kind or format")
+    return StreamingResponse(bulk.export_records(engine, kind, format),
+                             media_type="text/csv" if format == "csv" else "application/x-ndjson")
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", log_level="info")
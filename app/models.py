@@ -1,15 +1,51 @@
+import secrets
+import threading
+import time
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime
 from enum import Enum
 
-from sqlalchemy import Column, ForeignKey, DateTime, String, UUID, Boolean
+from sqlalchemy import Column, ForeignKey, DateTime, String, UUID, Boolean, Integer, UniqueConstraint, func
 from sqlalchemy.orm import declarative_base
 
+from app.compression import compress_value, decompress_value
+
 Base = declarative_base()
 
 USERNAME_REGEX = r"^[A-Za-z0-9]+$"
 PASSWORD_REGEX = r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^\w\s]).{12,}$"
 
+_uuid7_lock = threading.Lock()
+_uuid7_last_ms = 0
+_uuid7_counter = 0
+
+
+def uuid7() -> uuid.UUID:
+    """Time-ordered UUID version 7: 48 bit unix milliseconds, 12 bit counter, 62 random bits.
+
+    The counter keeps ids created by this process in the same millisecond
+    ordered, ids from different processes only need the clock.
+    """
+    global _uuid7_last_ms, _uuid7_counter
+    with _uuid7_lock:
+        timestamp_ms = time.time_ns() // 1_000_000
+        if timestamp_ms <= _uuid7_last_ms:
+            timestamp_ms = _uuid7_last_ms
+            _uuid7_counter += 1
+            if _uuid7_counter > 0xFFF:
+                timestamp_ms += 1
+                _uuid7_counter = 0
+        else:
+            _uuid7_counter = 0
+        _uuid7_last_ms = timestamp_ms
+        counter = _uuid7_counter
+    value = ((timestamp_ms & 0xFFFF_FFFF_FFFF) << 80
+             | 0x7 << 76
+             | counter << 64
+             | 0b10 << 62
+             | secrets.randbits(62))
+    return uuid.UUID(int=value)
+
 
 class Role(str, Enum):
     ADMIN = "ADMIN",
@@ -24,6 +60,7 @@ class User(Base):
     password = Column(String)
     role = Column(String)
     blocked = Column(Boolean, default=False)
+    version = Column(Integer, default=1, nullable=False)
 
 
 class Chat(Base):
@@ -31,6 +68,10 @@ class Chat(Base):
 
     id = Column(UUID, primary_key=True, default=uuid.uuid4)
     chat_name = Column(String, index=True)
+    # Bumped on every change of the chat messages, used for ETags
+    version = Column(Integer, default=1, nullable=False)
+    # Tombstone, the chat is hidden at once and purged in the background
+    deleted_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
 
 class UserChat(Base):
@@ -50,17 +91,30 @@ class MessageType(str, Enum):
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (UniqueConstraint('user_id', 'idempotency_key'),)
 
-    id = Column(UUID, primary_key=True, default=uuid.uuid4)
-    chat_id = Column(UUID, ForeignKey('chats.id'))
+    id = Column(UUID, primary_key=True, default=uuid7)
+    chat_id = Column(UUID, ForeignKey('chats.id'), index=True)
     user_id = Column(UUID, ForeignKey('users.id'))
-    value = Column(String)
+    # Large bodies are stored compressed, see app.compression
+    stored_value = Column("value", String)
     message_type: MessageType = Column(String)
-    datetime: datetime = Column(DateTime, default=datetime.now(timezone.utc))
+    datetime: datetime = Column(DateTime(timezone=True), server_default=func.now())
     read = Column(Boolean, default=False)
+    version = Column(Integer, default=1, nullable=False)
+    # Client supplied key of /sendMessage retries
+    idempotency_key = Column(String, nullable=True)
 
     # publisher: Mapped["User"] = relationship("User", foreign_keys=[user_id])
 
+    @property
+    def value(self) -> str | None:
+        return decompress_value(self.stored_value)
+
+    @value.setter
+    def value(self, value: str | None):
+        self.stored_value = compress_value(value)
+
     def to_dict(self):
         if isinstance(self, Message):
             return {
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import orjson
+
+PRESENCE_TTL_SECONDS = 30.0
+TYPING_TTL_SECONDS = 5.0
+BROADCAST_INTERVAL_SECONDS = 0.25
+
+logger = logging.getLogger("app.presence")
+
+
+class PresenceService:
+    """Keeps online and typing state per chat in memory.
+
+    Every change only marks the chat as dirty, the actual broadcast is sent
+    at most once per ``broadcast_interval`` with a snapshot of the chat state.
+    Entries expire after their TTL, so silent clients drop out on their own.
+    """
+
+    def __init__(self,
+                 broadcast: Callable[[str, str], Awaitable[None]],
+                 presence_ttl: float = PRESENCE_TTL_SECONDS,
+                 typing_ttl: float = TYPING_TTL_SECONDS,
+                 broadcast_interval: float = BROADCAST_INTERVAL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.broadcast = broadcast
+        self.presence_ttl = presence_ttl
+        self.typing_ttl = typing_ttl
+        self.broadcast_interval = broadcast_interval
+        self.clock = clock
+        self.online: dict[str, dict[str, float]] = {}
+        self.typing: dict[str, dict[str, float]] = {}
+        self.connections: dict[str, dict[str, int]] = {}
+        self.last_snapshot: dict[str, tuple[list[str], list[str]]] = {}
+        self.flush_handles: dict[str, asyncio.TimerHandle] = {}
+        self.flush_tasks: set[asyncio.Task] = set()
+
+    def connect(self, chat_id: str, username: str):
+        chat_connections = self.connections.setdefault(chat_id, {})
+        chat_connections[username] = chat_connections.get(username, 0) + 1
+        self.heartbeat(chat_id, username)
+
+    def disconnect(self, chat_id: str, username: str):
+        chat_connections = self.connections.get(chat_id, {})
+        count = chat_connections.get(username, 0) - 1
+        if count > 0:
+            chat_connections[username] = count
+            return
+        chat_connections.pop(username, None)
+        if not chat_connections:
+            self.connections.pop(chat_id, None)
+        self.online.get(chat_id, {}).pop(username, None)
+        self.typing.get(chat_id, {}).pop(username, None)
+        self._schedule_flush(chat_id)
+
+    def heartbeat(self, chat_id: str, username: str):
+        is_new = username not in self.online.get(chat_id, {})
+        self.online.setdefault(chat_id, {})[username] = self.clock() + self.presence_ttl
+        if is_new:
+            self._schedule_flush(chat_id)
+
+    def start_typing(self, chat_id: str, username: str):
+        self.heartbeat(chat_id, username)
+        is_new = username not in self.typing.get(chat_id, {})
+        self.typing.setdefault(chat_id, {})[username] = self.clock() + self.typing_ttl
+        if is_new:
+            self._schedule_flush(chat_id)
+
+    def stop_typing(self, chat_id: str, username: str):
+        if self.typing.get(chat_id, {}).pop(username, None) is not None:
+            self._schedule_flush(chat_id)
+
+    def handle_event(self, chat_id: str, username: str, event_type: str) -> bool:
+        if event_type == "heartbeat":
+            self.heartbeat(chat_id, username)
+        elif event_type == "typing":
+            self.start_typing(chat_id, username)
+        elif event_type == "stop_typing":
+            self.stop_typing(chat_id, username)
+        else:
+            return False
+        return True
+
+    def get_snapshot(self, chat_id: str) -> tuple[list[str], list[str]]:
+        now = self.clock()
+        for state in (self.online, self.typing):
+            chat_state = state.get(chat_id)
+            if chat_state is None:
+                continue
+            for username in [username for username, expires_at in chat_state.items() if expires_at <= now]:
+                del chat_state[username]
+            if not chat_state:
+                del state[chat_id]
+        return (sorted(self.online.get(chat_id, {})),
+                sorted(self.typing.get(chat_id, {})))
+
+    def _schedule_flush(self, chat_id: str, delay: float | None = None):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if delay is None:
+            delay = self.broadcast_interval
+        handle = self.flush_handles.get(chat_id)
+        if handle is not None:
+            if handle.when() <= loop.time() + delay:
+                return
+            handle.cancel()
+        self.flush_handles[chat_id] = loop.call_later(delay, self._start_flush, chat_id)
+
+    def _start_flush(self, chat_id: str):
+        task = asyncio.ensure_future(self.flush(chat_id))
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self, chat_id: str):
+        self.flush_handles.pop(chat_id, None)
+        try:
+            online, typing = self.get_snapshot(chat_id)
+            if self.last_snapshot.get(chat_id) != (online, typing):
+                if online or typing:
+                    self.last_snapshot[chat_id] = (online, typing)
+                else:
+                    self.last_snapshot.pop(chat_id, None)
+                await self.broadcast(chat_id, orjson.dumps({"type": "presence",
+                                                            "chat_id": chat_id,
+                                                            "online": online,
+                                                            "typing": typing}).decode())
+        except Exception:
+            logger.exception("Presence broadcast to chat %s failed", chat_id)
+        finally:
+            expirations = [*self.online.get(chat_id, {}).values(), *self.typing.get(chat_id, {}).values()]
+            if expirations:
+                self._schedule_flush(chat_id, max(min(expirations) - self.clock(), self.broadcast_interval))
+
+
+def parse_event_type(data: str) -> str | None:
+    try:
+        event = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(event, dict) and isinstance(event.get("type"), str):
+        return event["type"]
+    return None
@@ -0,0 +1,115 @@
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = "x-profile"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", "0.002"))
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_MS", "200")) / 1000
+
+current_endpoint: ContextVar[str | None] = ContextVar("current_endpoint", default=None)
+slow_query_logger = logging.getLogger("app.slow_query")
+
+
+class StackSampler:
+    """Samples the stack of one thread and counts identical stacks.
+
+    The result is written in the folded stacks format, one ``frame;frame;frame count``
+    line per stack, which flamegraph.pl, speedscope and inferno can read.
+    Sampling the event loop thread captures every request running on it at the
+    same time, so a request profile is loop-wide, not isolated to that request.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, name: str) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(PROFILE_DIR, f"{timestamp}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}.folded")
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        prune_profiles()
+        return path
+
+
+def prune_profiles(max_files: int = PROFILE_MAX_FILES):
+    """Removes the oldest profiles, file names start with a timestamp so they sort by age."""
+    names = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".folded"))
+    for name in names[:max(len(names) - max_files, 0)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            # Another worker pruned it first
+            pass
+
+
+def should_sample() -> bool:
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def describe_parameters(parameters) -> str:
+    """Shape of the bound parameters without their values."""
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(parameters[0], (dict, list, tuple)):
+        return f"{len(parameters)} x {describe_parameters(parameters[0])}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+
+def install_slow_query_log(engine: Engine, threshold: float = SLOW_QUERY_SECONDS):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start_time"].pop()
+        if duration >= threshold:
+            slow_query_logger.warning("Slow query %.1f ms from %s, parameters %s: %s",
+                                      duration * 1000,
+                                      current_endpoint.get() or "-",
+                                      describe_parameters(parameters),
+                                      statement)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start_time"):
+            context.connection.info["query_start_time"].pop()
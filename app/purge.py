@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+from typing import Callable
+from uuid import UUID
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+import app.service as service
+
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))
+PURGE_BATCH_INTERVAL_SECONDS = float(os.getenv("PURGE_BATCH_INTERVAL_SECONDS", "0.1"))
+PURGE_POLL_INTERVAL_SECONDS = float(os.getenv("PURGE_POLL_INTERVAL_SECONDS", "60"))
+
+logger = logging.getLogger("app.purge")
+
+
+class ChatPurger:
+    """Removes tombstoned chats in the background.
+
+    Messages and memberships are deleted in small committed batches with a
+    pause between them, so a large chat never holds long locks on ``messages``.
+    The chat row itself goes last.
+    """
+
+    def __init__(self,
+                 session_factory: Callable[[], Session],
+                 batch_size: int = PURGE_BATCH_SIZE,
+                 batch_interval: float = PURGE_BATCH_INTERVAL_SECONDS,
+                 poll_interval: float = PURGE_POLL_INTERVAL_SECONDS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.poll_interval = poll_interval
+        self.progress: dict[str, dict] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                chat_ids = await run_in_threadpool(self._call, service.get_deleted_chat_ids)
+                for chat_id in chat_ids:
+                    await self.purge_chat(chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Chat purge failed, retrying later")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def purge_chat(self, chat_id: UUID) -> dict:
+        progress = self.progress.setdefault(str(chat_id), {"status": "purging",
+                                                           "messages_deleted": 0,
+                                                           "memberships_deleted": 0})
+        progress["status"] = "purging"
+        for purge, counter in ((service.purge_chat_messages, "messages_deleted"),
+                               (service.purge_chat_memberships, "memberships_deleted")):
+            while True:
+                deleted = await run_in_threadpool(self._call, purge, chat_id, self.batch_size)
+                progress[counter] += deleted
+                if deleted < self.batch_size:
+                    break
+                await asyncio.sleep(self.batch_interval)
+        await run_in_threadpool(self._call, service.delete_purged_chat, chat_id)
+        progress["status"] = "done"
+        # Once the chat row is gone get_progress answers "done" from the database
+        self.progress.pop(str(chat_id), None)
+        return progress
+
+    def get_progress(self, db: Session, chat_id: UUID) -> dict:
+        progress = dict(self.progress.get(str(chat_id), {"status": "pending",
+                                                          "messages_deleted": 0,
+                                                          "memberships_deleted": 0}))
+        if progress["status"] != "done":
+            if service.is_chat_deleted(db, chat_id):
+                progress["messages_remaining"] = service.count_chat_messages(db, chat_id)
+            elif service.get_message_list_version(db, chat_id) is not None:
+                progress["status"] = "not_deleted"
+            else:
+                progress["status"] = "done"
+        return {"chat_id": str(chat_id), **progress}
+
+    def _call(self, function, *args):
+        with self.session_factory() as db:
+            return function(db, *args)
@@ -1,14 +1,17 @@
 from typing import Type
 from uuid import UUID
 
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, aliased
 
 from app.auth import AuthHandler
+from app.dedupe import DedupeCache
 from app.dtos import *
 from app.models import User, Chat, UserChat, Role, Message, MessageType
 
 auth_handler = AuthHandler()
+sent_message_cache = DedupeCache()
 
 
 def map_to_user_dto(user: User | Type[User]) -> UserDto:
@@ -55,32 +58,92 @@ def map_to_message_dto(message: Message | Type[Message] | None) -> MessageDto:
                       read=message.read)
 
 
-def send_message(db: Session, dto: SendMessageDto):
+def touch_chat(db: Session, chat_id: UUID) -> bool:
+    """Bumps the chat version, returns False when the chat is deleted.
+
+    The update locks the chat row, so a write that touched the chat either
+    commits before the tombstone or sees it and is rolled back.
+    """
+    return (db.query(Chat)
+            .filter(Chat.id == chat_id, Chat.deleted_at.is_(None))
+            .update({Chat.version: Chat.version + 1}, synchronize_session=False)) > 0
+
+
+def send_message(db: Session, dto: SendMessageDto) -> MessageDto | None:
     message = Message(chat_id=dto.chat_id,
                       user_id=dto.user_id,
                       message_type=dto.message_type,
-                      value=dto.value)
+                      value=dto.value,
+                      idempotency_key=dto.idempotency_key)
+    if not touch_chat(db, dto.chat_id):
+        db.rollback()
+        return None
     db.add(message)
     db.commit()
     db.refresh(message)
     return map_to_message_dto(message)
 
 
-def edit_message(db: Session, dto: EditMessageDto):
+def get_message_by_idempotency_key(db: Session, user_id: UUID | None, idempotency_key: str) -> MessageDto | None:
+    message = (db.query(Message)
+               .filter(Message.user_id == user_id, Message.idempotency_key == idempotency_key)
+               .first())
+    return map_to_message_dto(message) if message is not None else None
+
+
+def send_message_once(db: Session, dto: SendMessageDto) -> tuple[MessageDto | None, bool]:
+    """Sends the message unless a message with the same idempotency key was already sent.
+
+    Returns the message, None when the chat is deleted, and whether it was
+    created by this call. Retries are answered from ``sent_message_cache`` and,
+    after it forgot the key, from the unique (user_id, idempotency_key) constraint.
+    """
+    if dto.idempotency_key is None:
+        return send_message(db, dto), True
+    cache_key = (dto.user_id, dto.idempotency_key)
+    message_dto = sent_message_cache.get(cache_key)
+    if message_dto is not None:
+        return message_dto, False
+    message_dto = get_message_by_idempotency_key(db, dto.user_id, dto.idempotency_key)
+    created = message_dto is None
+    if created:
+        try:
+            message_dto = send_message(db, dto)
+            if message_dto is None:
+                return None, False
+        except IntegrityError:
+            db.rollback()
+            message_dto = get_message_by_idempotency_key(db, dto.user_id, dto.idempotency_key)
+            if message_dto is None:
+                raise
+            created = False
+    sent_message_cache.put(cache_key, message_dto, len(dto.idempotency_key) + len(message_dto.model_dump_json()))
+    return message_dto, created
+
+
+def edit_message(db: Session, dto: EditMessageDto) -> MessageDto | None:
     message = (db.query(Message)
                .filter(Message.id == dto.id)).first()
+    if message is None or not touch_chat(db, message.chat_id):
+        db.rollback()
+        return None
     message.message_type = dto.message_type
     message.value = dto.value
+    message.version += 1
     db.add(message)
     db.commit()
     db.refresh(message)
     return map_to_message_dto(message)
 
 
-def read_message(db: Session, message_id: UUID) -> MessageDto:
+def read_message(db: Session, message_id: UUID) -> MessageDto | None:
     message = (db.query(Message)
                .filter(Message.id == message_id)).first()
+    if message is None or not touch_chat(db, message.chat_id):
+        db.rollback()
+        return None
     message.read = True
+    message.version += 1
     db.add(message)
     db.commit()
     db.refresh(message)
@@ -88,12 +151,23 @@ def read_message(db: Session, message_id: UUID) -> MessageDto:
 
 
 def get_message_by_id(db: Session, message_id: UUID) -> MessageDto | None:
-    return map_to_message_dto((db.query(Message)
-                               .filter(Message.id == message_id)).first())
+    message = (db.query(Message)
+               .join(Chat, Chat.id == Message.chat_id)
+               .filter(Message.id == message_id, Chat.deleted_at.is_(None))).first()
+    return map_to_message_dto(message) if message is not None else None
 
 
-def delete_message(db, message_id):
+def get_message_chat_and_user_ids(db: Session, message_id: UUID) -> tuple | None:
+    return (db.query(Message.chat_id, Message.user_id)
+            .filter(Message.id == message_id)
+            .first())
+
+
+def delete_message(db, message_id) -> UUID | None:
     message: Message = db.query(Message).filter(Message.id == message_id).first()
+    if message is None or not touch_chat(db, message.chat_id):
+        db.rollback()
+        return None
     db.delete(message)
     db.commit()
     return message.chat_id
@@ -108,14 +182,9 @@ def map_chat_and_user_ids_to_chat_dto(db: Session, chat: Chat | Type[Chat], user
     for user in users:
         user_dtos.append(map_to_user_dto(user))
     if message is None:
-        message = map_to_message_dto(send_message(db, SendMessageDto(chat_id=chat.id,
-                                                                     user_id=None,
-                                                                     message_type=MessageType.TEXT,
-                                                                     value="Chat is created")))
-    else:
         message = map_to_message_dto(db.query(Message)
                                      .filter(Message.chat_id == chat.id)
-                                     .order_by(Message.datetime.desc())
+                                     .order_by(Message.datetime.desc(), Message.id.desc())
                                      .first())
     return ChatDto(id=chat.id,
                    chat_name=chat.chat_name,
@@ -137,7 +206,11 @@ def create_chat(db: Session, dto: CreateChatDto) -> ChatDto:
     db.commit()
     db.refresh(first_user_chat)
     db.refresh(second_user_chat)
-    return map_chat_and_user_ids_to_chat_dto(db, chat, dto.users)
+    message = send_message(db, SendMessageDto(chat_id=chat.id,
+                                              user_id=None,
+                                              message_type=MessageType.TEXT,
+                                              value="Chat is created"))
+    return map_chat_and_user_ids_to_chat_dto(db, chat, dto.users, message)
 
 
 def get_chat_by_id(db: Session, chat_id: UUID) -> ChatDto | None:
@@ -145,22 +218,113 @@ def get_chat_by_id(db: Session, chat_id: UUID) -> ChatDto | None:
     user_ids = []
     for user_chat in user_chats:
         user_ids.append(user_chat.user_id)
-    return map_chat_and_user_ids_to_chat_dto(db,
-                                             ((db.query(Chat)
-                                               .filter(Chat.id == chat_id)).first()),
-                                             user_ids)
+    chat = (db.query(Chat)
+            .filter(Chat.id == chat_id, Chat.deleted_at.is_(None))).first()
+    if chat is None:
+        return None
+    return map_chat_and_user_ids_to_chat_dto(db, chat, user_ids)
 
 
 def delete_chat(db, chat_id: UUID):
-    db.delete(db.query(UserChat).filter(UserChat.chat_id == chat_id))
-    db.delete(db.query(Chat).filter(Chat.id == chat_id))
+    (db.query(Chat)
+     .filter(Chat.id == chat_id, Chat.deleted_at.is_(None))
+     .update({Chat.deleted_at: func.now(), Chat.version: Chat.version + 1}, synchronize_session=False))
+    db.commit()
+
+
+def is_chat_deleted(db: Session, chat_id: UUID) -> bool:
+    return (db.query(Chat.id)
+            .filter(Chat.id == chat_id, Chat.deleted_at.is_not(None))
+            .first()) is not None
+
+
+def get_deleted_chat_ids(db: Session) -> list[UUID]:
+    return [row.id for row in db.query(Chat.id).filter(Chat.deleted_at.is_not(None)).all()]
+
+
+def count_chat_messages(db: Session, chat_id: UUID) -> int:
+    return db.query(func.count(Message.id)).filter(Message.chat_id == chat_id).scalar()
+
+
+def purge_chat_messages(db: Session, chat_id: UUID, batch_size: int) -> int:
+    message_ids = select(Message.id).where(Message.chat_id == chat_id).limit(batch_size)
+    deleted = (db.query(Message)
+               .filter(Message.id.in_(message_ids))
+               .delete(synchronize_session=False))
     db.commit()
+    return deleted
+
+
+def purge_chat_memberships(db: Session, chat_id: UUID, batch_size: int) -> int:
+    user_ids = select(UserChat.user_id).where(UserChat.chat_id == chat_id).limit(batch_size)
+    deleted = (db.query(UserChat)
+               .filter(UserChat.chat_id == chat_id, UserChat.user_id.in_(user_ids))
+               .delete(synchronize_session=False))
+    db.commit()
+    return deleted
+
+
+def delete_purged_chat(db: Session, chat_id: UUID):
+    (db.query(Chat)
+     .filter(Chat.id == chat_id, Chat.deleted_at.is_not(None))
+     .delete(synchronize_session=False))
+    db.commit()
+
+
+def get_message_version(db: Session, message_id: UUID) -> tuple | None:
+    return (db.query(Message.id, Message.version)
+            .join(Chat, Chat.id == Message.chat_id)
+            .filter(Message.id == message_id, Chat.deleted_at.is_(None))
+            .first())
+
+
+def get_user_version(db: Session, user_id: UUID) -> tuple | None:
+    return (db.query(User.id, User.version)
+            .filter(User.id == user_id)
+            .first())
+
+
+def get_message_list_version(db: Session, chat_id: UUID) -> tuple | None:
+    return (db.query(Chat.id, Chat.version)
+            .filter(Chat.id == chat_id, Chat.deleted_at.is_(None))
+            .first())
+
+
+def get_chat_version(db: Session, chat_id: UUID) -> tuple | None:
+    chat_version = get_message_list_version(db, chat_id)
+    if chat_version is None:
+        return None
+    user_versions = (db.query(User.id, User.version)
+                     .join(UserChat, UserChat.user_id == User.id)
+                     .filter(UserChat.chat_id == chat_id)
+                     .order_by(User.id)
+                     .all())
+    return tuple(chat_version), tuple(tuple(row) for row in user_versions)
+
+
+def get_chat_list_version(db: Session, user_id: UUID) -> tuple:
+    chat_versions = (db.query(Chat.id, Chat.version)
+                     .join(UserChat, UserChat.chat_id == Chat.id)
+                     .filter(UserChat.user_id == user_id, Chat.deleted_at.is_(None))
+                     .order_by(Chat.id)
+                     .all())
+    member_chats = aliased(UserChat)
+    user_versions = (db.query(User.id, User.version)
+                     .join(member_chats, member_chats.user_id == User.id)
+                     .join(UserChat, UserChat.chat_id == member_chats.chat_id)
+                     .filter(UserChat.user_id == user_id)
+                     .distinct()
+                     .order_by(User.id)
+                     .all())
+    return tuple(tuple(row) for row in chat_versions), tuple(tuple(row) for row in user_versions)
 
 
 def get_messages_by_chat_id(db: Session, chat_id: UUID) -> list[MessageDto] | list[Type[MessageDto]]:
     messages: list[Message] = (db.query(Message)
-                               .filter(Message.chat_id == chat_id)
-                               .order_by(Message.datetime.asc())).all()
+                               .join(Chat, Chat.id == Message.chat_id)
+                               .filter(Message.chat_id == chat_id, Chat.deleted_at.is_(None))
+                               # Rows written before UUIDv7 ids keep random uuid4 ids, so time comes first
+                               .order_by(Message.datetime.asc(), Message.id.asc())).all()
     message_dtos: list[MessageDto] = []
     for message in messages:
         message_dtos.append(map_to_message_dto(message))
@@ -184,7 +348,7 @@ def get_chat_dtos_list(db: Session, user_chats: set[UserChat] | set[Type[UserCha
             Message.chat_id,
             Message.id,
             func.row_number()
-            .over(partition_by=Message.chat_id, order_by=Message.datetime.desc())
+            .over(partition_by=Message.chat_id, order_by=(Message.datetime.desc(), Message.id.desc()))
             .label("row_num"),
         )
         .subquery()
@@ -214,13 +378,13 @@ def get_chat_dtos_list(db: Session, user_chats: set[UserChat] | set[Type[UserCha
     for user in users:
         users_dict.setdefault(user.id, user)
     chats: list[Chat] = (db.query(Chat)
-                         .filter(Chat.id.in_(chat_ids))).all()
+                         .filter(Chat.id.in_(chat_ids), Chat.deleted_at.is_(None))).all()
     chat_dtos: list[ChatDto] = []
     for chat in chats:
         chat_dtos.append(
             map_chat_and_users_dict_chat_user_dict_and_message_dict_to_chat_dto(chat, users_dict, chat_user_dict,
                                                                                 message_dict))
-    chat_dtos.sort(key=lambda chat_dto: chat_dto.last_message.datetime, reverse=True)
+    chat_dtos.sort(key=lambda chat_dto: (chat_dto.last_message.datetime, chat_dto.last_message.id), reverse=True)
     return chat_dtos
 
 
@@ -240,6 +404,7 @@ def edit_user_role(db: Session, dto: EditUserRole):
     user = (db.query(User)
             .filter(User.id == dto.id)).first()
     user.role = dto.role
+    user.version += 1
     db.add(user)
     db.commit()
     db.refresh(user)
@@ -249,6 +414,7 @@ def block_user(db: Session, user_id: UUID):
     user = (db.query(User)
             .filter(User.id == user_id)).first()
     user.block = True
+    user.version += 1
     db.add(user)
     db.commit()
     db.refresh(user)
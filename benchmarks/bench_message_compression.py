@@ -0,0 +1,78 @@
+"""Storage saved and CPU cost of compressed message bodies.
+
+Builds a corpus of short chat messages mixed with pasted logs, compares the
+stored size with and without compression and times building the DTOs of a
+``get_messages_by_chat_id`` page from plain and from compressed rows.
+Importing ``app`` connects to the application database, so run it next to the app:
+
+    docker-compose exec app python -m benchmarks.bench_message_compression --long-ratio 0.1
+    MESSAGE_COMPRESSION_DICTIONARY=dict.bin docker-compose exec app python -m benchmarks.bench_message_compression
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app.compression import compress_value, zstandard, DICTIONARY_ID
+from app.models import Message, MessageType
+from app.service import map_to_message_dto
+
+WORDS = ("hi", "ok", "thanks", "see", "you", "tomorrow", "meeting", "deploy", "done", "where", "are", "the", "logs")
+LOG_LINE = "2024-11-20 12:{minute:02d}:{second:02d} INFO request_id={request_id} path=/getChatList status=200 took={ms}ms\n"
+
+
+def make_corpus(count: int, long_ratio: float, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        if rng.random() < long_ratio:
+            corpus.append("".join(LOG_LINE.format(minute=rng.randrange(60), second=rng.randrange(60),
+                                                  request_id=uuid.UUID(int=rng.getrandbits(128)),
+                                                  ms=rng.randrange(1, 500))
+                                  for _ in range(rng.randrange(20, 200))))
+        else:
+            corpus.append(" ".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 20))))
+    return corpus
+
+
+def make_page(values: list[str]) -> list[Message]:
+    chat_id = uuid.uuid4()
+    return [Message(id=uuid.uuid4(), chat_id=chat_id, user_id=None, stored_value=value,
+                    message_type=MessageType.TEXT, datetime=datetime.now(timezone.utc), read=False)
+            for value in values]
+
+
+def time_page(page: list[Message], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        [map_to_message_dto(message) for message in page]
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def run(count: int, long_ratio: float, page_size: int, repeat: int):
+    corpus = make_corpus(count, long_ratio)
+    stored = [compress_value(value) for value in corpus]
+    plain_size = sum(len(value.encode()) for value in corpus)
+    stored_size = sum(len(value.encode()) for value in stored)
+    print(f"codec: {'zstd' if zstandard is not None else 'zlib'}, dictionary: {DICTIONARY_ID or 'none'}")
+    print(f"messages: {count}, compressed: {sum(a != b for a, b in zip(corpus, stored))}")
+    print(f"plain: {plain_size / 1024 / 1024:.1f}MB, stored: {stored_size / 1024 / 1024:.1f}MB, "
+          f"saved: {(1 - stored_size / plain_size) * 100:.1f}%")
+
+    plain_page = make_page(corpus[:page_size])
+    compressed_page = make_page(stored[:page_size])
+    plain_ms = time_page(plain_page, repeat)
+    compressed_ms = time_page(compressed_page, repeat)
+    print(f"page of {page_size}: plain {plain_ms:.2f}ms, compressed {compressed_ms:.2f}ms, "
+          f"overhead {compressed_ms - plain_ms:.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--long-ratio", type=float, default=0.05)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    run(args.count, args.long_ratio, args.page_size, args.repeat)
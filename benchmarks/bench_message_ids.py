@@ -0,0 +1,68 @@
+"""Compares random uuid4 and time-ordered uuid7 message ids on PostgreSQL.
+
+Inserts the same amount of rows into two scratch tables and prints insert
+throughput and primary key index size for each scheme. Importing ``app``
+connects to the application database, so run it next to the app:
+
+    docker-compose exec app python -m benchmarks.bench_message_ids --rows 1000000
+"""
+import argparse
+import os
+import time
+import uuid
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, UUID, create_engine, func, text
+
+from app.db import SQLALCHEMY_DATABASE_URL
+from app.models import uuid7
+
+SCHEMES = {
+    "uuid4": uuid.uuid4,
+    "uuid7": uuid7,
+}
+
+
+def create_table(metadata: MetaData, scheme: str) -> Table:
+    return Table(f"bench_messages_{scheme}", metadata,
+                 Column("id", UUID, primary_key=True),
+                 Column("chat_id", UUID, index=True),
+                 Column("value", String),
+                 Column("datetime", DateTime(timezone=True), server_default=func.now()))
+
+
+def run(database_url: str, rows: int, batch_size: int):
+    engine = create_engine(database_url)
+    metadata = MetaData()
+    tables = {scheme: create_table(metadata, scheme) for scheme in SCHEMES}
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    chat_id = uuid.uuid4()
+    try:
+        print(f"{'scheme':<8}{'rows/s':>12}{'pk index':>14}{'table':>14}")
+        for scheme, make_id in SCHEMES.items():
+            table = tables[scheme]
+            started = time.perf_counter()
+            with engine.begin() as connection:
+                for offset in range(0, rows, batch_size):
+                    connection.execute(table.insert(),
+                                       [{"id": make_id(), "chat_id": chat_id, "value": "benchmark message"}
+                                        for _ in range(min(batch_size, rows - offset))])
+            elapsed = time.perf_counter() - started
+            with engine.connect() as connection:
+                index_size, table_size = connection.execute(
+                    text("SELECT pg_relation_size(:index_name), pg_relation_size(:table_name)"),
+                    {"index_name": f"{table.name}_pkey", "table_name": table.name}
+                ).one()
+            print(f"{scheme:<8}{rows / elapsed:>12.0f}{index_size / 1024 / 1024:>12.1f}MB"
+                  f"{table_size / 1024 / 1024:>12.1f}MB")
+    finally:
+        metadata.drop_all(engine)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", SQLALCHEMY_DATABASE_URL))
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    args = parser.parse_args()
+    run(args.database_url, args.rows, args.batch_size)
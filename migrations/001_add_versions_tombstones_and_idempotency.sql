@@ -0,0 +1,36 @@
+-- Brings a database created before these columns existed to the current models.
+-- create_all only creates missing tables, it never alters existing ones.
+-- Every statement is idempotent, the script can be run more than once.
+BEGIN;
+
+-- ETag versions
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- Server-side message timestamps, existing values were written in UTC.
+-- The type change rewrites the table, so it only runs on a column that was not converted yet.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1
+               FROM information_schema.columns
+               WHERE table_schema = current_schema()
+                 AND table_name = 'messages'
+                 AND column_name = 'datetime'
+                 AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE messages ALTER COLUMN datetime TYPE TIMESTAMP WITH TIME ZONE USING datetime AT TIME ZONE 'UTC';
+    END IF;
+END
+$$;
+ALTER TABLE messages ALTER COLUMN datetime SET DEFAULT now();
+
+-- Chat tombstones and batched purge
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITH TIME ZONE;
+CREATE INDEX IF NOT EXISTS ix_chats_deleted_at ON chats (deleted_at);
+CREATE INDEX IF NOT EXISTS ix_messages_chat_id ON messages (chat_id);
+
+-- Idempotent message sends
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR;
+CREATE UNIQUE INDEX IF NOT EXISTS messages_user_id_idempotency_key_key ON messages (user_id, idempotency_key);
+
+COMMIT;
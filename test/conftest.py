@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
 from app.main import app
 from app.models import Base
@@ -25,3 +26,11 @@ def db_session():
         yield session
     finally:
         session.close()
+
+
+@pytest.fixture(scope="function")
+def sqlite_engine():
+    sqlite_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=sqlite_engine)
+    yield sqlite_engine
+    sqlite_engine.dispose()
@@ -1,3 +1,18 @@
+import asyncio
+import io
+import json
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from app import bulk, compression, profiling
+from app.models import Chat, Message, UserChat
+from app.purge import ChatPurger
+
+
 def test_register_user(client):
     data = {"username": "test_user", "password": "_Test@1234$!&)"}
     response = client.post("/register/", json=data)
@@ -73,3 +88,261 @@ def test_get_message_list(client):
     response = client.get(f"/getMessageList/{str(chat_list_response.json()[0]['id'])}", cookies={"token": token})
     assert response.status_code == 200
     assert isinstance(response.json(), list)
+
+
+def test_chat_websocket_presence(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    with client.websocket_connect(f"/ws/chat/{chat_id}", headers={"cookie": f"token={token}"}) as websocket:
+        websocket.send_text('{"type": "typing"}')
+        for _ in range(3):
+            event = json.loads(websocket.receive_text())
+            if "test_user" in event["typing"]:
+                break
+        assert event["type"] == "presence"
+        assert "test_user" in event["online"]
+        assert "test_user" in event["typing"]
+
+
+def test_get_message_list_not_modified(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    response = client.get(f"/getMessageList/{chat_id}", cookies={"token": token})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = client.get(f"/getMessageList/{chat_id}", cookies={"token": token}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    data = {"chat_id": chat_id, "user_id": str(auth_response.json()), "message_type": "TEXT", "value": "Changed"}
+    client.post("/sendMessage", json=data, cookies={"token": token})
+    response = client.get(f"/getMessageList/{chat_id}", cookies={"token": token}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+
+def test_get_chat_by_id_not_modified(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    response = client.get(f"/getChatById/{chat_id}", cookies={"token": token})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = client.get(f"/getChatById/{chat_id}", cookies={"token": token}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_profile_path_only_for_admins(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+    response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token},
+                          headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    assert "x-profile-path" not in response.headers
+
+def test_message_list_is_time_ordered(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    for value in ("First", "Second"):
+        data = {"chat_id": chat_id, "user_id": str(auth_response.json()), "message_type": "TEXT", "value": value}
+        client.post("/sendMessage", json=data, cookies={"token": token})
+    messages = client.get(f"/getMessageList/{chat_id}", cookies={"token": token}).json()
+    assert [message["id"] for message in messages] == sorted(message["id"] for message in messages)
+    assert [message["value"] for message in messages][-2:] == ["First", "Second"]
+    assert messages[-2]["datetime"] <= messages[-1]["datetime"]
+
+
+def test_chat_websocket_send_frames(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    with client.websocket_connect(f"/ws/chat/{chat_id}", headers={"cookie": f"token={token}"}) as websocket:
+        websocket.send_text('{"type": "send", "request_id": "1", "message_type": "TEXT", "value": "One"}')
+        websocket.send_text('{"type": "send", "request_id": "2", "message_type": "TEXT", "value": "Two"}')
+        acks = {}
+        for _ in range(10):
+            event = json.loads(websocket.receive_text())
+            if event.get("type") == "ack":
+                acks[event["request_id"]] = event["id"]
+            if len(acks) == 2:
+                break
+        assert set(acks) == {"1", "2"}
+
+        websocket.send_text(f'{{"type": "delete", "request_id": "3", "id": "{acks["1"]}"}}')
+        for _ in range(10):
+            data = websocket.receive_text()
+            if data.startswith("{") and json.loads(data).get("request_id") == "3":
+                break
+        assert json.loads(data)["type"] == "ack"
+
+
+def test_delete_chat_hides_chat(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    auth_response_1 = client.post("/authenticate/", json={"username": "test_user_1", "password": "1_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    data = {"chat_name": "Chat To Delete", "users": [str(auth_response.json()), str(auth_response_1.json())]}
+    chat_id = client.post("/createChat", json=data, cookies={"token": token}).json()["id"]
+    response = client.delete(f"/deleteChat/{chat_id}", cookies={"token": token})
+    assert response.status_code == 200
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    assert chat_id not in [chat["id"] for chat in chat_list_response.json()]
+    response = client.get(f"/deleteChatProgress/{chat_id}", cookies={"token": token})
+    assert response.status_code == 200
+    assert response.json()["status"] in ("pending", "purging", "done")
+
+
+
+def test_purge_chat_in_batches(sqlite_engine):
+    session_factory = sessionmaker(bind=sqlite_engine)
+    chat_id = uuid.uuid4()
+    with session_factory() as db:
+        db.add(Chat(id=chat_id, chat_name="Purged Chat", deleted_at=datetime.now(timezone.utc)))
+        db.add_all([UserChat(chat_id=chat_id, user_id=uuid.uuid4()) for _ in range(3)])
+        db.add_all([Message(chat_id=chat_id, value=f"Message {index}", message_type="TEXT") for index in range(5)])
+        db.commit()
+
+    purger = ChatPurger(session_factory, batch_size=2, batch_interval=0)
+    progress = asyncio.run(purger.purge_chat(chat_id))
+    assert progress == {"status": "done", "messages_deleted": 5, "memberships_deleted": 3}
+    assert purger.progress == {}
+    with sqlite_engine.connect() as connection:
+        assert connection.execute(select(func.count(Message.id))).scalar() == 0
+        assert connection.execute(select(func.count()).select_from(UserChat)).scalar() == 0
+        assert connection.execute(select(func.count(Chat.id))).scalar() == 0
+
+
+def test_send_message_idempotency_key(client):
+    auth_response = client.post("/authenticate/", json={"username": "test_user", "password": "_Test@1234$!&)"})
+    token = auth_response.cookies.get("token")
+
+    chat_list_response = client.get(f"/getChatList/{str(auth_response.json())}", cookies={"token": token})
+    chat_id = str(chat_list_response.json()[0]["id"])
+    data = {"chat_id": chat_id, "user_id": str(auth_response.json()), "message_type": "TEXT",
+            "value": "Sent once", "idempotency_key": "retry-key-1"}
+    first_response = client.post("/sendMessage", json=data, cookies={"token": token})
+    retry_response = client.post("/sendMessage", json=data, cookies={"token": token})
+    assert first_response.status_code == 200
+    assert retry_response.json()["id"] == first_response.json()["id"]
+
+    messages = client.get(f"/getMessageList/{chat_id}", cookies={"token": token}).json()
+    assert [message["value"] for message in messages].count("Sent once") == 1
+
+
+def test_bulk_ndjson_round_trip(sqlite_engine):
+    chat_id = uuid.uuid4()
+    bulk.import_records(sqlite_engine, "chats", [{"id": str(chat_id), "chat_name": "Imported Chat"}])
+    values = [f"Imported message {index}" for index in range(5)]
+    ndjson = "".join(json.dumps({"chat_id": str(chat_id), "value": value}) + "\n" for value in values)
+
+    done = bulk.import_records(sqlite_engine, "messages", bulk.read_records(io.StringIO(ndjson), "ndjson"),
+                               batch_size=2)
+    assert done == 5
+
+    exported = [json.loads(line)
+                for line in "".join(bulk.export_records(sqlite_engine, "messages", "ndjson")).splitlines()]
+    assert sorted(message["value"] for message in exported) == values
+    assert {message["chat_id"] for message in exported} == {str(chat_id)}
+    with sqlite_engine.connect() as connection:
+        # One bump per committed batch of messages
+        assert connection.execute(select(Chat.version).where(Chat.id == chat_id)).scalar() == 4
+
+
+def test_bulk_rejects_plain_password(sqlite_engine):
+    with pytest.raises(bulk.BulkImportError) as error:
+        bulk.import_records(sqlite_engine, "users", [{"username": "imported_user", "password": "_Test@1234$!&)"}])
+    assert error.value.records == 0
+
+
+
+def test_bulk_rejects_names_the_dtos_reject(sqlite_engine):
+    password = bulk.auth_handler.get_password_hash("_Test@1234$!&)")
+    with pytest.raises(bulk.BulkImportError) as error:
+        bulk.import_records(sqlite_engine, "users", [{"username": "imported.user", "password": password}])
+    assert "username" in str(error.value)
+    with pytest.raises(bulk.BulkImportError) as error:
+        bulk.import_records(sqlite_engine, "chats", bulk.read_records(io.StringIO('{"chat_name": ""}\n'), "ndjson"))
+    assert "chat_name" in str(error.value)
+
+
+@pytest.mark.parametrize("line", ['[1]', '{"chat_name": "Imported Chat", "version": [1]}'])
+def test_bulk_rejects_malformed_records(sqlite_engine, line):
+    with pytest.raises(bulk.BulkImportError) as error:
+        bulk.import_records(sqlite_engine, "chats", bulk.read_records(io.StringIO(line + "\n"), "ndjson"))
+    assert error.value.records == 0
+
+def test_bulk_resume_from_offset(sqlite_engine):
+    records = [{"id": str(uuid.uuid4()), "chat_name": f"Imported Chat {index}"} for index in range(4)]
+    broken_records = records[:2] + [{"id": str(uuid.uuid4())}] + records[3:]
+    with pytest.raises(bulk.BulkImportError) as error:
+        bulk.import_records(sqlite_engine, "chats", broken_records, batch_size=2)
+    assert error.value.records == 2
+
+    done = bulk.import_records(sqlite_engine, "chats", records, batch_size=2, offset=error.value.records)
+    assert done == 4
+    with sqlite_engine.connect() as connection:
+        assert connection.execute(select(func.count(Chat.id))).scalar() == 4
+
+
+def test_message_value_round_trip():
+    long_value = "2024-11-20 12:00:00 INFO path=/getChatList status=200\n" * compression.THRESHOLD
+    message = Message(value=long_value)
+    assert message.stored_value.startswith(compression.MARKER)
+    assert len(message.stored_value) < len(long_value)
+    assert message.value == long_value
+
+    marked_value = compression.MARKER + "z:not compressed"
+    message = Message(value=marked_value)
+    assert message.stored_value != marked_value
+    assert message.value == marked_value
+
+    legacy_message = Message(stored_value="Written before compression")
+    assert legacy_message.value == "Written before compression"
+
+
+
+@pytest.mark.parametrize("parameters, shape", [
+    ({"id": uuid.uuid4(), "name": "chat"}, "{id: UUID, name: str}"),
+    ((1, "chat"), "(int, str)"),
+    ([{"id": 1}, {"id": 2}, {"id": 3}], "3 x {id: int}"),
+])
+def test_describe_parameters(parameters, shape):
+    assert profiling.describe_parameters(parameters) == shape
+
+
+def test_stack_sampler_dump(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    sampler = profiling.StackSampler(0)
+    sampler.stacks["main (main.py:1);handler (main.py:2)"] = 3
+    sampler.stacks["main (main.py:1)"] = 1
+
+    path = sampler.dump("GET /getChatList/1")
+    assert path.startswith(str(tmp_path))
+    with open(path) as file:
+        assert file.read().splitlines() == ["main (main.py:1);handler (main.py:2) 3", "main (main.py:1) 1"]
+
+
+def test_prune_profiles_keeps_newest(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    for index in range(5):
+        (tmp_path / f"2024010{index}T000000000000-GET.folded").write_text("main 1\n")
+
+    profiling.prune_profiles(max_files=2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["20240103T000000000000-GET.folded",
+                                                                 "20240104T000000000000-GET.folded"]